@@ -1,16 +1,21 @@
 """Get a list of Toyota vehicles from the Toyota website."""
 import datetime
+import itertools
 import json
 import os
+import re
 import sys
 import uuid
 from functools import cache
 from secrets import randbelow
 from time import sleep
 from timeit import default_timer as timer
+from typing import NamedTuple
 
+import httpx
+import numpy as np
+import orjson
 import pandas as pd
-import requests
 
 from yotagrabber import config, wafbypass
 
@@ -20,27 +25,188 @@ USE_LOCAL_DATA_ONLY = False
 # Get the model that we should be searching for.
 MODEL = os.environ.get("MODEL")
 
+# Share one HTTP/2 client across all requests so the zone queries can run over the
+# same connection. httpx falls back to HTTP/1.1 if the server doesn't offer h2.
+CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=4, max_connections=8),
+    ),
+    timeout=15.0,
+)
+
+# Number of times a failed page is retried before giving up.
+MAX_PAGE_RETRIES = 5
+
+# Pre-generate lead IDs with a single urandom() call and cycle through them.
+_UUID_BYTES = os.urandom(16 * 256)
+LEAD_IDS = itertools.cycle(
+    [
+        str(uuid.UUID(bytes=_UUID_BYTES[i : i + 16], version=4))
+        for i in range(0, len(_UUID_BYTES), 16)
+    ]
+)
+
+# Headers captured from the browser that httpx must set on its own.
+SKIPPED_HEADERS = {"connection", "content-length", "host", "keep-alive"}
+
+# Fields kept from each vehicle in the query results. Nested fields are flattened
+# into dotted column names, like pandas.json_normalize() would do. The vehicles
+# query only asks Toyota for these fields, so keep the two in sync.
+VEHICLE_FIELDS = (
+    "vin",
+    "dealerCategory",
+    "dealerCd",
+    "dealerMarketingName",
+    "dealerWebsite",
+    "holdStatus",
+    "isPreSold",
+    "year",
+    "media",
+    "options",
+)
+NESTED_VEHICLE_FIELDS = (
+    ("eta", "currToDate"),
+    ("price", "baseMsrp"),
+    ("price", "totalMsrp"),
+    ("price", "dioTotalDealerSellingPrice"),
+    ("model", "marketingName"),
+    ("extColor", "marketingName"),
+    ("drivetrain", "code"),
+)
+
+# Zip codes searched to cover the whole country.
+ZIP_CODES = {
+    "west": "84101",  # Salt Lake City
+    "central": "73007",  # Oklahoma City
+    "east": "27608",  # Raleigh
+}
+
+# Raw columns used to build the curated data.
+RAW_COLUMNS = [
+    "eta.currToDate",
+    "vin",
+    "dealerCategory",
+    "price.baseMsrp",
+    "price.totalMsrp",
+    "price.dioTotalDealerSellingPrice",
+    "isPreSold",
+    "holdStatus",
+    "year",
+    "drivetrain.code",
+    # "media",
+    "model.marketingName",
+    "extColor.marketingName",
+    "dealerMarketingName",
+    # "dealerWebsite",
+    "Dealer State",
+    # "options",
+]
+
+RENAMES = {
+    "eta.currToDate": "ETA",
+    "vin": "VIN",
+    "price.baseMsrp": "Base MSRP",
+    "price.totalMsrp": "TSRP MSRP",
+    "model.marketingName": "Model",
+    "extColor.marketingName": "Color",
+    "dealerCategory": "Shipping Status",
+    "dealerMarketingName": "Dealer",
+    # "dealerWebsite": "Dealer Website",
+    "isPreSold": "Pre-Sold",
+    "holdStatus": "Hold Status",
+    "year": "Year",
+    "drivetrain.code": "Drivetrain",
+    # "options": "Options",
+}
+
+SHIPPING_STATUSES = {
+    "A": "Factory to port",
+    "F": "Port to dealer",
+    "G": "At dealer",
+}
+
+# Columns written to the curated data, in order.
+CURATED_COLUMNS = [
+    "ETA",
+    "Year",
+    "Model",
+    "Color",
+    "Base MSRP",
+    "TSRP MSRP",
+    "Markup",
+    "Dealer Price",
+    "Shipping Status",
+    "Pre-Sold",
+    "Hold Status",
+    "VIN",
+    "Dealer",
+    # "Dealer Website",
+    "Dealer State",
+    # "Image",
+    # "Options",
+]
+
+# Curated columns with only a few distinct values, stored as categories.
+CATEGORY_COLUMNS = [
+    "Model",
+    "Color",
+    "Shipping Status",
+    "Hold Status",
+    "Dealer",
+    "Dealer State",
+]
+
+
+class QueryTemplate(NamedTuple):
+    """Vehicles query split around the values that change on every request."""
+
+    parts: tuple
+    placeholders: tuple
+
+    def fill(self, **values):
+        """Join the query back together with a value for each place holder."""
+        pieces = [self.parts[0]]
+        for placeholder, part in zip(self.placeholders, self.parts[1:]):
+            pieces.append(values[placeholder])
+            pieces.append(part)
+
+        return "".join(pieces)
+
 
 @cache
-def get_vehicles_query(zone="west"):
-    """Read vehicles query from a file."""
+def get_vehicles_query():
+    """Read vehicles query from a file and search all zones at once.
+
+    The file holds the search for a single zone, which is repeated here under each
+    zone's alias.
+    """
     with open(f"{config.BASE_DIRECTORY}/graphql/vehicles.graphql", "r") as fileh:
-        query = fileh.read()
+        zone_query = fileh.read()
 
-    zip_codes = {
-        "west": "84101",  # Salt Lake City
-        "central": "73007",  # Oklahoma City
-        "east": "27608",  # Raleigh
-    }
+    # Add one aliased search per zone. The page number, distance and lead ID
+    # change on every request, so query_toyota() fills those in.
+    zones = "".join(
+        zone_query.replace("ZONE", zone).replace("ZIPCODE", zip_code)
+        for zone, zip_code in ZIP_CODES.items()
+    )
+    zones = zones.replace("MODELCODE", MODEL)
+
+    # Split around the place holders once so each request only needs a join.
+    split = re.split("(PAGENUMBER|DISTANCEMILES|LEADIDUUID)", f"query {{\n{zones}}}\n")
 
-    # Replace certain place holders in the query with values.
-    zip_code = zip_codes[zone]
-    query = query.replace("ZIPCODE", zip_code)
-    query = query.replace("MODELCODE", MODEL)
-    query = query.replace("DISTANCEMILES", str(5823 + randbelow(1000)))
-    query = query.replace("LEADIDUUID", str(uuid.uuid4()))
+    return QueryTemplate(tuple(split[::2]), tuple(split[1::2]))
 
-    return query
+
+@cache
+def get_dealers():
+    """Read the dealer states from a file."""
+    return pd.read_csv(
+        f"{config.BASE_DIRECTORY}/data/dealers.csv",
+        usecols=["dealerId", "state"],
+        dtype={"dealerId": "int32"},
+    ).rename(columns={"state": "Dealer State"})
 
 
 def read_local_data():
@@ -49,44 +215,77 @@ def read_local_data():
 
 
 def query_toyota(page_number, query, headers):
-    """Query Toyota for a list of vehicles."""
+    """Query Toyota for a list of vehicles in each zone."""
+    # Fill in the page number and rotate the distance and lead ID.
+    query = query.fill(
+        PAGENUMBER=str(page_number),
+        DISTANCEMILES=str(5823 + randbelow(1000)),
+        LEADIDUUID=next(LEAD_IDS),
+    )
 
-    # Replace the page number in the query
-    query = query.replace("PAGENUMBER", str(page_number))
+    # The browser headers can describe a different request body than ours.
+    headers = {k: v for k, v in headers.items() if k.lower() not in SKIPPED_HEADERS}
 
     # Make request.
     json_post = {"query": query}
     url = "https://api.search-inventory.toyota.com/graphql"
-    resp = requests.post(
-        url,
-        json=json_post,
-        headers=headers,
-        timeout=15,
-    )
+    try:
+        resp = CLIENT.post(
+            url,
+            json=json_post,
+            headers=headers,
+        )
+    except httpx.HTTPError as exc:
+        print(f"Request to Toyota failed: {exc!r}")
+        return None
+
+    # Rate limits and server errors can still come back with a JSON body.
+    if resp.status_code != 200:
+        print(f"Toyota returned HTTP {resp.status_code}")
+        print(resp.headers)
+        print(resp.text)
+        return None
 
     try:
-        result = resp.json()["data"]["locateVehiclesByZip"]
-    except requests.exceptions.JSONDecodeError:
+        data = orjson.loads(resp.content).get("data")
+    except (orjson.JSONDecodeError, AttributeError):
         print(resp.headers)
         print(resp.text)
         return None
 
-    if not result or "vehicleSummary" not in result:
+    if not data:
         print(resp.text)
         return None
-    else:
-        return result
+
+    results = {
+        zone: result if result and "vehicleSummary" in result else None
+        for zone, result in data.items()
+    }
+    if None in results.values():
+        print(resp.text)
+
+    return results
+
+
+def flatten_vehicle(vehicle):
+    """Pick the fields we use from a vehicle and flatten the nested ones."""
+    row = {field: vehicle.get(field) for field in VEHICLE_FIELDS}
+    for parent, child in NESTED_VEHICLE_FIELDS:
+        row[f"{parent}.{child}"] = (vehicle.get(parent) or {}).get(child)
+
+    return row
 
 
 def get_all_pages():
     """Get all pages of results for a query to Toyota."""
-    df = pd.DataFrame()
+    # Collect the raw vehicle records and build the DataFrame once at the end.
+    # Duplicate VINs are skipped as they arrive.
+    vehicles = []
+    seen_vins = set()
     page_number = 1
 
     # Read the query.
-    west_query = get_vehicles_query(zone="west")
-    central_query = get_vehicles_query(zone="central")
-    east_query = get_vehicles_query(zone="east")
+    query = get_vehicles_query()
 
     # Get headers by bypassing the WAF.
     print("Bypassing WAF")
@@ -95,8 +294,12 @@ def get_all_pages():
     # Start a timer.
     timer_start = timer()
 
-    # Set a last run counter.
-    last_run_counter = 0
+    # Wait a little between pages and back off when Toyota's API has trouble.
+    delay = 1
+    failures = 0
+
+    # Vehicles added from the current page, across any retries.
+    added = 0
 
     while True:
         # Toyota's API won't return any vehicles past past 40.
@@ -113,38 +316,63 @@ def get_all_pages():
         # Get a page of vehicles.
         print(f"Getting page {page_number} of {MODEL} vehicles")
 
-        west_result = query_toyota(page_number, west_query, headers)
-        if west_result and "vehicleSummary" in west_result:
-            print("West:    ", len(west_result["vehicleSummary"]))
-            df = pd.concat([df, pd.json_normalize(west_result["vehicleSummary"])])
-
-        central_result = query_toyota(page_number, central_query, headers)
-        if central_result and "vehicleSummary" in central_result:
-            print("Central: ", len(central_result["vehicleSummary"]))
-            df = pd.concat([df, pd.json_normalize(central_result["vehicleSummary"])])
-
-        east_result = query_toyota(page_number, east_query, headers)
-        if east_result and "vehicleSummary" in east_result:
-            print("East:    ", len(east_result["vehicleSummary"]))
-            df = pd.concat([df, pd.json_normalize(east_result["vehicleSummary"])])
-
-        # Drop any duplicate VINs.
-        df.drop_duplicates(subset=["vin"], inplace=True)
+        # Query all three zones in a single request.
+        results = query_toyota(page_number, query, headers)
+        failed = results is None
+        last_page = not failed
+        for zone, result in (results or {}).items():
+            if result:
+                print(f"{zone.title()}:".ljust(9), len(result["vehicleSummary"]))
+                new_vehicles = [
+                    x
+                    for x in result["vehicleSummary"]
+                    if x["vin"] not in seen_vins and not seen_vins.add(x["vin"])
+                ]
+                vehicles.extend(new_vehicles)
+                added += len(new_vehicles)
+
+                # Keep going until Toyota says this zone has no pages left.
+                pagination = result.get("pagination") or {}
+                total_pages = pagination.get("totalPages")
+                if not total_pages or page_number < total_pages:
+                    last_page = False
+            else:
+                failed = True
+                last_page = False
+
+        # Retry the same page after backing off when any zone fails.
+        if failed:
+            failures += 1
+            if failures > MAX_PAGE_RETRIES:
+                print(f"Giving up on page {page_number} after {failures} tries.")
+                break
+
+            delay = min(delay * 2, 30)
+            print(f"Retrying page {page_number} in {delay} seconds.\n")
+            sleep(delay)
+            continue
 
-        print(f"Found {len(df)} (+{len(df)-last_run_counter}) vehicles so far.\n")
+        failures = 0
+        print(f"Found {len(vehicles)} (+{added}) vehicles so far.\n")
 
         # If we didn't find more cars from the previous run, we've found them all.
-        if len(df) == last_run_counter:
+        if not added:
+            print("All vehicles found.")
+            break
+
+        # If every zone is on its last page, we're at the end of the results.
+        if last_page:
             print("All vehicles found.")
             break
 
-        last_run_counter = len(df)
         page_number += 1
+        added = 0
 
-        sleep(10)
+        delay = max(delay / 2, 1)
+        sleep(delay)
         continue
 
-    return df
+    return pd.DataFrame([flatten_vehicle(x) for x in vehicles])
 
 
 def update_vehicles():
@@ -164,139 +392,82 @@ def update_vehicles():
         df.sort_values("vin", inplace=True)
         df.to_parquet(f"output/{MODEL}_raw.parquet", index=False)
 
-    # Add dealer data.
-    dealers = pd.read_csv(f"{config.BASE_DIRECTORY}/data/dealers.csv")[
-        ["dealerId", "state"]
-    ]
-    dealers.rename(columns={"state": "Dealer State"}, inplace=True)
-    df["dealerCd"] = df["dealerCd"].apply(pd.to_numeric)
-    df = df.merge(dealers, left_on="dealerCd", right_on="dealerId")
-
-    renames = {
-        "eta.currToDate": "ETA",
-        "vin": "VIN",
-        "price.baseMsrp": "Base MSRP",
-        "price.totalMsrp": "TSRP MSRP",
-        "model.marketingName": "Model",
-        "extColor.marketingName": "Color",
-        "dealerCategory": "Shipping Status",
-        "dealerMarketingName": "Dealer",
-        # "dealerWebsite": "Dealer Website",
-        "isPreSold": "Pre-Sold",
-        "holdStatus": "Hold Status",
-        "year": "Year",
-        "drivetrain.code": "Drivetrain",
-        # "options": "Options",
-    }
+    # Drop old models and vehicles without a color before doing any other work.
+    last_year = datetime.date.today().year - 1
+    df = df[(df["year"] >= last_year) & df["extColor.marketingName"].notna()]
+
+    # Years fit in a small integer type. Prices are left alone because downcasting
+    # them to float32 would round the cents.
+    df = df.assign(year=lambda d: pd.to_numeric(d["year"], downcast="integer"))
 
     with open(f"output/models.json", "r") as fileh:
         title = [x["title"] for x in json.load(fileh) if x["modelCode"] == MODEL][0]
 
+    # Build the curated view in a single pass so pandas only creates one new frame.
     df = (
-        df[
-            [
-                "eta.currToDate",
-                "vin",
-                "dealerCategory",
-                "price.baseMsrp",
-                "price.totalMsrp",
-                "price.dioTotalDealerSellingPrice",
-                "isPreSold",
-                "holdStatus",
-                "year",
-                "drivetrain.code",
-                # "media",
-                "model.marketingName",
-                "extColor.marketingName",
-                "dealerMarketingName",
-                # "dealerWebsite",
-                "Dealer State",
-                #"options",
-            ]
-        ]
-        .copy(deep=True)
-        .rename(columns=renames)
+        # Add dealer data, matching the int32 dealer IDs.
+        df.assign(dealerCd=lambda d: pd.to_numeric(d["dealerCd"], errors="coerce"))
+        .dropna(subset=["dealerCd"])
+        .astype({"dealerCd": "int32"})
+        .merge(get_dealers(), left_on="dealerCd", right_on="dealerId")[RAW_COLUMNS]
+        .rename(columns=RENAMES)
+        .assign(
+            **{
+                # Remove the model name (like 4Runner) from the model column (like
+                # TRD Pro) and add the drivetrain to reduce complexity.
+                "Model": lambda d: d["Model"].str.replace(f"{title} ", "")
+                + " "
+                + d["Drivetrain"],
+                # Clean up colors with extra tags.
+                "Color": lambda d: d["Color"].str.removesuffix(" [extra_cost_color]"),
+                # Calculate the markup (no dealer price means no markup) and add it
+                # to the base price. The column holds None values when no vehicle
+                # has a dealer price, so make it numeric first.
+                "Markup": lambda d: np.nan_to_num(
+                    pd.to_numeric(d["price.dioTotalDealerSellingPrice"]).to_numpy(),
+                    nan=0,
+                ),
+                "Dealer Price": lambda d: d["Base MSRP"].to_numpy() + d["Markup"],
+                "Pre-Sold": lambda d: d["Pre-Sold"].fillna(False).astype(bool),
+                # Keep any status codes we don't know about as they are.
+                "Shipping Status": lambda d: d["Shipping Status"]
+                .map(SHIPPING_STATUSES)
+                .fillna(d["Shipping Status"]),
+                # When ETA is null, set as unknown, otherwise format as date.
+                "ETA": lambda d: d["ETA"].str.split("T").str[0].fillna("Unknown"),
+                # Arrow strings sort faster than Python objects.
+                "VIN": lambda d: d["VIN"].astype("string[pyarrow]"),
+                # "Image": lambda d: d["media"].apply(
+                #     lambda x: [y["href"] for y in x if y["type"] == "carjellyimage"][0]
+                # ),
+                # "Options": lambda d: extract_marketing_long_names(d["Options"]),
+            }
+        )[CURATED_COLUMNS]
+        .sort_values(by=["VIN"])
+        .astype(dict.fromkeys(CATEGORY_COLUMNS, "category"))
     )
 
-    # Remove the model name (like 4Runner) from the model column (like TRD Pro).
-    df["Model"] = df["Model"].str.replace(f"{title} ", "")
-
-    # Clean up missing colors and colors with extra tags.
-    df = df[df["Color"].notna()]
-    df["Color"] = df["Color"].str.replace(" [extra_cost_color]", "", regex=False)
-
-    # Calculate the dealer price + markup.
-    df["Dealer Price"] = df["Base MSRP"] + df["price.dioTotalDealerSellingPrice"]
-    df["Dealer Price"] = df["Dealer Price"].fillna(df["Base MSRP"])
-    df["Markup"] = df["Dealer Price"] - df["Base MSRP"]
-    df.drop(columns=["price.dioTotalDealerSellingPrice"], inplace=True)
-
-    # Remove any old models that might still be there.
-    last_year = datetime.date.today().year - 1
-    df.drop(df[df["Year"] < last_year].index, inplace=True)
-
-    statuses = {None: False, 1: True, 0: False}
-    df.replace({"Pre-Sold": statuses}, inplace=True)
-
-    statuses = {
-        "A": "Factory to port",
-        "F": "Port to dealer",
-        "G": "At dealer",
-    }
-    df.replace({"Shipping Status": statuses}, inplace=True)
-    
-    # when ETA is null, set as unknown, otherwise format as date
-    if df["ETA"].isnull().any():
-        df["ETA"].fillna("Unknown", inplace=True)
-    else:
-        df["ETA"] = df["ETA"].apply(lambda dt: dt.split("T")[0])
-
-    # df["Image"] = df["media"].apply(
-    #     lambda x: [x["href"] for x in x if x["type"] == "carjellyimage"][0]
-    # )
-    # df.drop(columns=["media"], inplace=True)
-
-    # df["Options"] = df["Options"].apply(extract_marketing_long_names)
-
-    # Add the drivetrain to the model name to reduce complexity.
-    df["Model"] = df["Model"] + " " + df["Drivetrain"]
-
-    df = df[
-        [
-            "ETA",
-            "Year",
-            "Model",
-            "Color",
-            "Base MSRP",
-            "TSRP MSRP",
-            "Markup",
-            "Dealer Price",
-            "Shipping Status",
-            "Pre-Sold",
-            "Hold Status",
-            "VIN",
-            "Dealer",
-            # "Dealer Website",
-            "Dealer State",
-            # "Image",
-            #"Options",
-        ]
-    ]
-
-    # Write the data to a file.
-    df.sort_values(by=["VIN"], inplace=True)
+    # Write the data to files.
     df.to_csv(f"output/{MODEL}.csv", index=False)
+    df.to_parquet(f"output/{MODEL}.parquet", index=False, compression="zstd")
 
 
-def extract_marketing_long_names(options_raw):
+def extract_marketing_long_names(options):
     """extracts `marketingName` from `Options` col"""
-    options = set()
-    for item in options_raw:
-        if item.get("marketingName"):
-            options.add(item.get("marketingName"))
-        elif item.get("marketingLongName"):
-            options.add(item.get("marketingLongName"))
-        else:
-            continue
+    # One row per option, keeping the index of the vehicle it came from.
+    exploded = options.explode().dropna()
+    names = pd.DataFrame(
+        exploded.tolist(),
+        index=exploded.index,
+        columns=["marketingName", "marketingLongName"],
+    )
+
+    # Prefer the marketing name and fall back to the long name.
+    names = names.mask(names.eq(""))
+    names = names["marketingName"].fillna(names["marketingLongName"]).dropna()
 
-    return " | ".join(sorted(options))
+    return (
+        names.groupby(level=0)
+        .agg(lambda x: " | ".join(sorted(x.unique())))
+        .reindex(options.index, fill_value="")
+    )